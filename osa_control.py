@@ -1,9 +1,51 @@
 import os
+import math
 import time
 import datetime
 import csv
-import matplotlib.pyplot as plt
-import pyvisa
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Maps every byte to itself if printable ASCII, otherwise to '.'
+_PRINTABLE = bytes(b if 32 <= b <= 126 else 0x2E for b in range(256))
+
+_PYVISA = None
+_RM = None
+
+
+def _get_pyvisa():
+    """
+    Import pyvisa on first use, keeping it off the startup path.
+    """
+    global _PYVISA
+    if _PYVISA is None:
+        import pyvisa
+        import pyvisa.constants
+        _PYVISA = pyvisa
+    return _PYVISA
+
+
+def _get_rm():
+    """
+    Return the process-wide VISA ResourceManager, creating it on first use.
+    """
+    global _RM
+    if _RM is None:
+        _RM = _get_pyvisa().ResourceManager()
+    return _RM
+
+
+def _parse_trace_response(response):
+    """
+    Parse a "<count>,<v1>,<v2>,..." WDAT/LDAT response into a float array.
+    Raises ValueError if the number of values does not match the count.
+    """
+    count, _, values = response.partition(',')
+    data = np.fromstring(values, sep=',', dtype=np.float64)
+    if len(data) != int(count):
+        raise ValueError(f"Trace response has {len(data)} values, expected {int(count)}")
+    return data
 
 
 class AQ6315EController:
@@ -16,9 +58,14 @@ class AQ6315EController:
                  use_auto_reference=True,
                  reference_level_nw=12.0,
                  resolution_nm=0.05,
-                 averaging_count=5):
-        self.rm = pyvisa.ResourceManager()
+                 averaging_count=5,
+                 flush_every_line=False,
+                 use_srq=False):
+        # pyvisa and matplotlib are imported where first needed to keep startup fast
+        self.rm = _get_rm()
         self.osa = self.rm.open_resource(gpib_address, timeout=10000)  # 10s timeout
+        self.osa.read_termination = '\r\n'
+        self.osa.write_termination = '\r\n'
         self.sensitivity = sensitivity
         self.start_wavelength = start_wavelength
         self.stop_wavelength = stop_wavelength
@@ -27,15 +74,27 @@ class AQ6315EController:
         self.reference_level_nw = reference_level_nw
         self.resolution_nm = resolution_nm
         self.averaging_count = averaging_count
+        self.flush_every_line = flush_every_line
+        self.use_srq = use_srq
+        self._logfile = None
+        self._log_dir = None
+        self._last_ts_sec = None
+        self._last_ts_str = ""
+        self._srq_enabled = False
+        self._plot_thread = None
+        self._plot_error = None
+        self._plot_failure = None
+        self._plot_target = None
 
     def setup_osa(self):
         """
         Configure OSA before data acquisition.
         """
+        pyvisa = _get_pyvisa()
         try:
             self.osa.write("*IDN?")
             raw_idn = self.osa.read_raw()
-            idn = ''.join([chr(b) if 32 <= b <= 126 else '.' for b in raw_idn])
+            idn = raw_idn.translate(_PRINTABLE).decode('ascii')
             print(f"Connected to: {idn.strip()}")
 
             time.sleep(1)
@@ -59,7 +118,6 @@ class AQ6315EController:
             cmd = resolution_map.get(self.resolution_nm)
             if cmd:
                 print(f"sending command: {cmd}")
-                self.osa.query("RESLN?")
                 self.osa.write(cmd)
             else:
                 raise ValueError(f"Unsupported resolution: {self.resolution_nm}")
@@ -73,6 +131,9 @@ class AQ6315EController:
                 self.osa.write(f"REFLU{self.reference_level_nw:.2f}")
 
             self.osa.write("ACTTRC A")  # Set Trace A as active output trace
+            self.osa.write("LDTDIG3")  # 3 decimal digits in ASCII trace output
+            if self.use_srq:
+                self.enable_sweep_srq()
 
             print("OSA configured with sensitivity, resolution, units, and averaging.")
             self.log(self.log_dir, "OSA successfully configured.")
@@ -92,64 +153,198 @@ class AQ6315EController:
         """
         Append a log message with timestamp to osa_run.log
         """
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_path = os.path.join(directory, "osa_run.log")
-        with open(log_path, "a", encoding="utf-8") as logfile:
-            logfile.write(f"[{timestamp}] {message}\n")
+        now = int(time.time())
+        if now != self._last_ts_sec:
+            # Only reformat when the second rolls over
+            self._last_ts_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+            self._last_ts_sec = now
+        if self._logfile is None or self._log_dir != directory:
+            if self._logfile is not None:
+                self._logfile.close()
+            log_path = os.path.join(directory, "osa_run.log")
+            self._logfile = open(log_path, "a", buffering=65536, encoding="utf-8")
+            self._log_dir = directory
+        self._logfile.write(f"[{self._last_ts_str}] {message}\n")
+        if self.flush_every_line:
+            self._logfile.flush()
+
+    def close(self):
+        """
+        Wait for any pending plot, then flush and close the log file.
+        Re-raises any error from the background plot.
+        """
+        try:
+            self._join_plot_thread()
+            if self._plot_error is not None:
+                error, self._plot_error = self._plot_error, None
+                raise error
+        finally:
+            if self._logfile is not None:
+                self._logfile.flush()
+                self._logfile.close()
+                self._logfile = None
+                self._log_dir = None
+
+    def _join_plot_thread(self):
+        """
+        Wait for the background plot, if any, and log its outcome from the calling thread.
+        Its error is kept for close().
+        """
+        if self._plot_thread is None:
+            return
+        self._plot_thread.join()
+        self._plot_thread = None
+        png_filename, directory = self._plot_target
+        failure, self._plot_failure = self._plot_failure, None
+        if failure is None:
+            print(f"Plot saved to {png_filename}")
+            self.log(directory, f"Plot saved: {png_filename}")
+        else:
+            print(f"Plot failed for {png_filename}: {failure}")
+            self.log(directory, f"Plot failed: {png_filename}: {failure}")
+            if self._plot_error is None:
+                self._plot_error = failure
+
+    @staticmethod
+    def wavelength_range_command(start, stop):
+        return f"STAWL{start:.2f};STPWL{stop:.2f}"
 
     def set_wavelength_range(self, start, stop):
-        self.osa.write(f"STAWL{start:.2f}")
-        self.osa.write(f"STPWL{stop:.2f}")
+        self.osa.write(self.wavelength_range_command(start, stop))
+
+    def enable_sweep_srq(self):
+        """
+        Ask the OSA to raise SRQ on operation complete (*ESE 1 + *SRE 32, with *OPC sent
+        after each SGL) so sweeps can be awaited without polling.
+        Opt-in via use_srq: *OPC on sweep end has not been verified on the AQ6315E, and an
+        instrument that ignores it only shows up as a timeout on the first sweep, after
+        which SWEEP? polling takes over.
+        """
+        pyvisa = _get_pyvisa()
+        try:
+            self.osa.write("*CLS;*ESE 1;*SRE 32")  # OPC bit -> ESB (status byte bit 5) -> SRQ
+            self.osa.enable_event(pyvisa.constants.EventType.service_request,
+                                  pyvisa.constants.EventMechanism.queue)
+            self._srq_enabled = True
+        except (pyvisa.VisaIOError, NotImplementedError) as e:
+            print(f"SRQ not available, polling sweep status instead: {e}")
+            self._srq_enabled = False
+
+    def disable_sweep_srq(self):
+        """
+        Stop queueing SRQ events and drop any already queued.
+        """
+        pyvisa = _get_pyvisa()
+        self._srq_enabled = False
+        self.osa.disable_event(pyvisa.constants.EventType.service_request,
+                               pyvisa.constants.EventMechanism.queue)
+        self.osa.discard_events(pyvisa.constants.EventType.service_request,
+                                pyvisa.constants.EventMechanism.queue)
+
+    def start_sweep_and_wait(self, wavelength_range=None, timeout_ms=120000):
+        """
+        Start a single sweep and block until it finishes. If wavelength_range is given as
+        (start, stop), the range is programmed in the same GPIB write as SGL.
+        """
+        cmd = "SGL"
+        if wavelength_range is not None:
+            cmd = f"{self.wavelength_range_command(*wavelength_range)};SGL"
+
+        if self._srq_enabled:
+            pyvisa = _get_pyvisa()
+            self.osa.discard_events(pyvisa.constants.EventType.service_request,
+                                    pyvisa.constants.EventMechanism.queue)
+            self.osa.write(f"{cmd};*OPC")
+            try:
+                self.osa.wait_on_event(pyvisa.constants.EventType.service_request, timeout_ms)
+                self.osa.read_stb()  # Clear the SRQ
+                self.osa.query("*ESR?")  # Clear the OPC bit for the next sweep
+                return
+            except pyvisa.VisaIOError as e:
+                print(f"No SRQ after sweep, falling back to polling: {e}")
+                self.disable_sweep_srq()
+        else:
+            self.osa.write(cmd)
 
-    def start_sweep_and_wait(self):
-        self.osa.write("SGL")
         while int(self.osa.query("SWEEP?")) > 0:
             time.sleep(0.2)
 
-    def get_trace_data(self):
+    def read_trace_raw(self):
+        """
+        Read the active trace as raw WDAT/LDAT response strings.
+        """
         trace_idx = int(self.osa.query("ACTV?"))  # NEW
 
         trace = "ABC"[trace_idx]  # NEW
-        self.osa.write("LDTDIG3")
-        time.sleep(0.5)
-        wavelengths = self.osa.query(f"WDAT{trace}").strip().split(',')[1:]
-        levels = self.osa.query(f"LDAT{trace}").strip().split(',')[1:]
+        raw_wl = self.osa.query(f"WDAT{trace}")
+        # Size reads from the point count the OSA reports (<= 16 bytes per ASCII point with
+        # LDTDIG3) so each later response arrives in a single chunk
+        points = int(raw_wl.partition(',')[0])
+        self.osa.chunk_size = max(self.osa.chunk_size, (points + 1) * 16)
+        raw_lv = self.osa.query(f"LDAT{trace}")
+
+        return raw_wl, raw_lv
+
+    @staticmethod
+    def parse_trace(raw_wl, raw_lv, trim_last=False):
+        wavelengths = _parse_trace_response(raw_wl)
+        levels = _parse_trace_response(raw_lv)
+        if trim_last:
+            wavelengths = wavelengths[:-1]
+            levels = levels[:-1]
 
         return wavelengths, levels
 
+    def get_trace_data(self):
+        return self.parse_trace(*self.read_trace_raw())
+
     def run_scan_loop(self):
-        current_start = self.start_wavelength
-        all_wavelengths = []
-        all_levels = []
+        # Round before ceil so float error in the span can't add a zero-width final segment
+        n_segments = max(0, math.ceil(round((self.stop_wavelength - self.start_wavelength) / self.step_size, 9)))
+        starts = self.start_wavelength + self.step_size * np.arange(n_segments)
+        stops = np.minimum(starts + self.step_size, self.stop_wavelength)
+        # Drop the last point of every segment but the final one; it repeats the next segment's first
+        trims = np.ones_like(starts, dtype=bool)
+        trims[-1:] = False
+        pending = []
 
         self.log(self.log_dir, "Starting scan loop...")
-        while current_start < self.stop_wavelength:
-            current_stop = min(current_start + self.step_size, self.stop_wavelength)
-            self.set_wavelength_range(current_start, current_stop)
-            self.start_sweep_and_wait()
-            wl, lv = self.get_trace_data()
+        # The GPIB bus only carries one transfer at a time, so the trace read itself stays
+        # synchronous; parsing of each segment runs on a worker while the next one sweeps.
+        with ThreadPoolExecutor(max_workers=1) as parser:
+            for start, stop, trim_last in zip(starts, stops, trims):
+                self.start_sweep_and_wait((start, stop))
+                raw_wl, raw_lv = self.read_trace_raw()
+                pending.append(parser.submit(self.parse_trace, raw_wl, raw_lv, trim_last))
+                if len(pending) >= 2:
+                    # Surface a bad previous segment now rather than after the whole run
+                    pending[-2].result()
 
-            if current_stop < self.stop_wavelength:
-                wl = wl[:-1]
-                lv = lv[:-1]
-
-            all_wavelengths += wl
-            all_levels += lv
-            current_start += self.step_size
+            chunks = [future.result() for future in pending]
 
         self.log(self.log_dir, "Scan loop completed.")
-        return all_wavelengths, all_levels
+        if not chunks:
+            return np.empty(0), np.empty(0)
+        chunks_wl, chunks_lv = zip(*chunks)
+        return np.concatenate(chunks_wl), np.concatenate(chunks_lv)
 
     def save_trace(self, wavelengths, levels, directory):
         """
         Save the spectrum data as CSV and plot as PNG.
+        wavelengths and levels are float arrays, as returned by run_scan_loop.
         """
+        # Only one plot renders at a time; a failed earlier plot must not block saving this data
+        self._join_plot_thread()
+
+        # No-op for float64 arrays; converts any other sequence once for both CSV and plot
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        levels = np.asarray(levels, dtype=np.float64)
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         csv_filename = os.path.join(directory, "osa_trace.csv")
         png_filename = os.path.join(directory, "osa_plot.png")
 
         # Save CSV
-        with open(csv_filename, mode='w', newline='', encoding='utf-8') as csvfile:
+        with open(csv_filename, mode='w', newline='', encoding='utf-8', buffering=1048576) as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(["# AQ6315E Spectrum Data"])
             writer.writerow([f"# Timestamp: {now}"])
@@ -165,39 +360,59 @@ class AQ6315EController:
             writer.writerow([f"# Units: μW/nm"])
             writer.writerow([])
             writer.writerow(["Wavelength (nm)", "Level (μW/nm)"])
-
-            for w, l in zip(wavelengths, levels):
-                writer.writerow([w, l])
+            # Numeric body bypasses the csv module; match its \r\n row terminator
+            np.savetxt(csvfile, np.column_stack([wavelengths, levels]),
+                       fmt='%.10g', delimiter=',', newline='\r\n')
         print(f"CSV data saved to {csv_filename}")
+        self.log(directory, f"Data saved: {csv_filename}")
+
+        # Render the plot in the background; close() waits for it
+        self._plot_target = (png_filename, directory)
+        self._plot_thread = threading.Thread(target=self._render_png,
+                                             args=(wavelengths, levels, png_filename),
+                                             daemon=False)
+        self._plot_thread.start()
 
-        # Plot and save figure
-        float_wl = list(map(float, wavelengths))
-        float_lv = list(map(float, levels))
+    def _render_png(self, wavelengths, levels, png_filename):
+        """
+        Plot the spectrum and save it as PNG. Runs on the plot thread, so it only
+        records its error; printing and logging happen in _join_plot_thread.
+        """
+        try:
+            # Figure + Agg canvas avoids pyplot's global state and backend
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-        plt.figure(figsize=(10, 6))
-        plt.plot(float_wl, float_lv, lw=1.2)
-        plt.title("OSA Spectrum")
-        plt.xlabel("Wavelength (nm)")
-        plt.ylabel("Level (μW/nm)")
-        plt.grid(True)
-        plt.tight_layout()
-        plt.savefig(png_filename, dpi=300)
-        plt.close()
+            fig = Figure(figsize=(10, 6))
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            ax.plot(wavelengths, levels, lw=1.2)
+            ax.set_title("OSA Spectrum")
+            ax.set_xlabel("Wavelength (nm)")
+            ax.set_ylabel("Level (μW/nm)")
+            ax.grid(True)
+            fig.tight_layout()
+            fig.savefig(png_filename, dpi=300)
+        except Exception as e:
+            self._plot_failure = e
 
-        print(f"Plot saved to {png_filename}")
-        self.log(directory, f"Data saved: {csv_filename}, Plot saved: {png_filename}")
 
 def create_output_directory():
-    today = datetime.datetime.now().strftime("%Y-%m-%d")
-    base_dir = os.path.join(os.getcwd(), today)
+    now = datetime.datetime.now()
+    base_dir = os.path.join(os.getcwd(), now.strftime("%Y-%m-%d"))
     os.makedirs(base_dir, exist_ok=True)
-    counter = 1
-    while True:
-        run_dir = os.path.join(base_dir, f"run_{counter:04d}")
-        if not os.path.exists(run_dir):
-            os.makedirs(run_dir)
-            return run_dir
-        counter += 1
+    run_dir = os.path.join(base_dir, f"run_{now.strftime('%H%M%S_%f')}")
+    try:
+        os.makedirs(run_dir)
+        return run_dir
+    except FileExistsError:
+        counter = 1
+        while True:
+            candidate = f"{run_dir}_{counter:04d}"
+            if not os.path.exists(candidate):
+                os.makedirs(candidate)
+                return candidate
+            counter += 1
 
 
 if __name__ == "__main__":
@@ -215,6 +430,9 @@ if __name__ == "__main__":
     )
 
     controller.log_dir = output_dir
-    controller.setup_osa()
-    wavelengths, levels = controller.run_scan_loop()
-    controller.save_trace(wavelengths, levels, output_dir)
\ No newline at end of file
+    try:
+        controller.setup_osa()
+        wavelengths, levels = controller.run_scan_loop()
+        controller.save_trace(wavelengths, levels, output_dir)
+    finally:
+        controller.close()
\ No newline at end of file